@@ -3,19 +3,38 @@ import os
 import logging
 import asyncio
 import aiohttp
+import httpx
 import json
 import re
 import html
-from io import BytesIO
+import random
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from datetime import timedelta
+from functools import partial
+from urllib.parse import urlsplit, urljoin
 from typing import Optional, Callable, Awaitable
 
 from telegram import Update, InputMediaPhoto, InputMediaVideo
 from telegram.constants import ParseMode
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
-from telegram.error import TelegramError, BadRequest, TimedOut
+from telegram.error import TelegramError, BadRequest, TimedOut, RetryAfter
 
 import asyncpraw
-from bs4 import BeautifulSoup
+
+try:
+    import uvloop
+except ImportError:  # optional; not available on Windows
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is the fallback
+    orjson = None
 
 # ---------- LOGGING ----------
 logging.basicConfig(
@@ -46,147 +65,535 @@ REDDIT_USERNAME = get_env_var("REDDIT_USERNAME")
 REDDIT_PASSWORD = get_env_var("REDDIT_PASSWORD")
 
 SUBREDDITS_DB_PATH = "subreddits.db"
-POSTED_IDS_PATH = "posted_ids.json"
+POSTED_IDS_PATH = "posted_ids.log"
+LEGACY_POSTED_IDS_PATH = "posted_ids.json"
+USER_AGENT = "TelegramRedditBot/2.2 by anarq42"
+
+# Group 1 is the base36 submission id, wherever asyncpraw's id_from_url would find it:
+# after the first comments/ or gallery/ segment on any reddit.com host, or as the redd.it path.
+REDDIT_LINK_RE = re.compile(
+    r"https?://(?:[a-z0-9-]+\.)*(?:reddit\.com/(?:[^?#]*?/)?(?:comments|gallery)/|redd\.it/)([a-z0-9]+)",
+    re.IGNORECASE,
+)
+SOURCE_TAG_RE = re.compile(rb"<source\b[^>]*>", re.IGNORECASE)
+TAG_ATTR_RE = re.compile(rb"""([a-z-]+)\s*=\s*["']([^"']*)["']""", re.IGNORECASE)
+# Audio tracks in a v.redd.it DASH manifest: CMAF_AUDIO_<kbps>.mp4 or DASH_AUDIO_<kbps>.mp4, or DASH_audio.mp4 on older posts.
+DASH_AUDIO_RE = re.compile(rb"<BaseURL>\s*((?:CMAF|DASH)_(?:AUDIO_(\d+)|audio)\.mp4)\s*</BaseURL>", re.IGNORECASE)
+
+# ---------- HTTP ----------
+FETCH_RETRIES = 3
+FETCH_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+FETCH_CONCURRENCY_PER_HOST = 4
+FETCH_CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # Bot API multipart upload limit
+MEDIA_WRITE_TIMEOUT = 180  # seconds to push a MAX_UPLOAD_BYTES upload to Telegram; PTB's default is 20
+UPLOAD_CONCURRENCY = 5
+MAX_MEDIA_GROUP_SIZE = 10  # Telegram's cap on items per send_media_group
+MUX_TIMEOUT = 120
+FFMPEG_PATH = shutil.which("ffmpeg")  # None disables the DASH audio mux
+EXTENSION_MEDIA_TYPES = {".jpg": "photo", ".jpeg": "photo", ".png": "photo", ".gif": "gif", ".mp4": "video"}
+GFY_REDGIFS_HOSTS = frozenset({"gfycat.com", "www.gfycat.com", "redgifs.com", "www.redgifs.com", "v3.redgifs.com"})
+# Hosts Telegram can fetch by URL itself, so the bot needn't download and re-upload the file.
+DIRECT_MEDIA_HOSTS = frozenset({"i.redd.it", "preview.redd.it", "i.imgur.com"})
+
+JSON_LOADS = orjson.loads if orjson else json.loads
+REDGIFS_API_URL = "https://api.redgifs.com/v2"
+REDGIFS_TOKEN_TTL = 20 * 60 * 60  # temporary tokens are valid for roughly a day
+
+# Caps simultaneous downloads per host across all posts, so a burst can't hammer one CDN.
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+def create_http_session() -> aiohttp.ClientSession:
+    # One pooled session for the bot lifetime so media downloads reuse keep-alive connections.
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=8, ttl_dns_cache=300, keepalive_timeout=75),
+        timeout=aiohttp.ClientTimeout(total=45, connect=10),
+        headers={"User-Agent": USER_AGENT},
+    )
 
 # ---------- SUBREDDITS MAPPING ----------
 def load_subreddits_mapping(file_path):
     mapping = {}
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"): continue
-                parts = line.split(",")
-                if len(parts) != 2:
-                    logging.warning(f"Skipping malformed line in {file_path}: {line}")
-                    continue
-                subreddit_name, topic_id = parts
-                mapping[subreddit_name.strip().lower()] = int(topic_id.strip())
+        with open(file_path, "r", encoding="utf-8") as f: lines = f.read().splitlines()
     except FileNotFoundError:
-        logging.warning(f"{file_path} not found. Starting with empty mapping.")
+        logging.warning("%s not found. Starting with empty mapping.", file_path)
+        return mapping
     except Exception:
         logging.exception("Failed to load subreddit mapping")
+        return mapping
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"): continue
+        subreddit_name, _, topic_id = line.partition(",")
+        # int() is the only reliable check; str.isdigit() also passes characters like "²" that it rejects.
+        try:
+            topic_id = int(topic_id)
+        except ValueError:
+            topic_id = None
+        if not subreddit_name.strip() or topic_id is None:
+            logging.warning("Skipping malformed line in %s: %s", file_path, line)
+            continue
+        mapping[subreddit_name.strip().lower()] = topic_id
     return mapping
 
+def save_subreddit_topic(file_path, subreddit, topic_id):
+    # Only the entry for this subreddit changes; every other line keeps its case, order and comments.
+    try:
+        with open(file_path, "r", encoding="utf-8") as f: lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    key, found = subreddit.lower(), False
+    for i, line in enumerate(lines):
+        name, sep, _ = line.partition(",")
+        if sep and not name.strip().startswith("#") and name.strip().lower() == key:
+            lines[i], found = f"{name.strip()},{topic_id}", True
+    if not found: lines.append(f"{subreddit},{topic_id}")
+    # Write-then-rename so a crash mid-write never leaves a truncated mapping behind.
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(f"{line}\n" for line in lines)
+    os.replace(tmp_path, file_path)
+
 # ---------- TRACK POSTED IDS ----------
+POSTED_IDS_LIMIT = 10_000
+POSTED_IDS_FLUSH_INTERVAL = 5
+# Serialises log appends and compactions, which may run in worker threads.
+_posted_ids_file_lock = threading.Lock()
+
+class PostedIds:
+    # Insertion-ordered id set that forgets the oldest entries past `maxlen`; the Reddit stream
+    # only yields new submissions, so ids that old can't come back.
+    def __init__(self, ids=(), maxlen=POSTED_IDS_LIMIT):
+        self.maxlen = maxlen
+        self._ids = OrderedDict()
+        for post_id in ids: self.add(post_id)
+
+    def add(self, post_id):
+        self._ids[post_id] = None
+        self._ids.move_to_end(post_id)
+        if len(self._ids) > self.maxlen: self._ids.popitem(last=False)
+
+    def __contains__(self, post_id): return post_id in self._ids
+    def __iter__(self): return iter(self._ids)
+    def __len__(self): return len(self._ids)
+
 def load_posted_ids():
+    ids = []
     try:
-        with open(POSTED_IDS_PATH, "r") as f:
-            return set(json.load(f))
+        with open(LEGACY_POSTED_IDS_PATH, "rb") as f: ids.extend(JSON_LOADS(f.read()))
     except (FileNotFoundError, json.JSONDecodeError):
-        return set()
+        pass
+    try:
+        with open(POSTED_IDS_PATH, "r") as f: ids.extend(line.rstrip("\n") for line in f if line.strip())
+    except FileNotFoundError:
+        pass
+    return PostedIds(ids)
 
-def save_posted_ids(posted_ids):
+def append_posted_ids(post_ids):
     try:
-        with open(POSTED_IDS_PATH, "w") as f: json.dump(list(posted_ids), f)
+        with _posted_ids_file_lock, open(POSTED_IDS_PATH, "a") as f:
+            f.writelines(f"{post_id}\n" for post_id in post_ids)
     except Exception as e:
-        logging.error(f"Failed to save posted ids: {e}")
+        logging.error("Failed to append posted ids: %s", e)
+
+def compact_posted_ids(posted_ids):
+    # Rewrite the log from the bounded in-memory set, folding in (and retiring) the legacy JSON file.
+    try:
+        tmp_path = f"{POSTED_IDS_PATH}.tmp"
+        with _posted_ids_file_lock:
+            with open(tmp_path, "w") as f: f.writelines(f"{post_id}\n" for post_id in posted_ids)
+            os.replace(tmp_path, POSTED_IDS_PATH)
+            if os.path.exists(LEGACY_POSTED_IDS_PATH): os.remove(LEGACY_POSTED_IDS_PATH)
+    except Exception as e:
+        logging.error("Failed to compact posted ids: %s", e)
+
+def flush_pending_posted_ids(app: Application):
+    pending, app.bot_data["posted_ids_pending"] = app.bot_data.get("posted_ids_pending") or [], []
+    if pending: append_posted_ids(pending)
+
+async def flush_posted_ids_task(app: Application):
+    # Coalesce writes: a burst of posts marks the log dirty many times but costs one append.
+    app_data = app.bot_data
+    appended = 0
+    while True:
+        await app_data["posted_ids_dirty"].wait()
+        await asyncio.sleep(POSTED_IDS_FLUSH_INTERVAL)
+        async with app_data["posted_ids_lock"]:
+            app_data["posted_ids_dirty"].clear()
+            pending, app_data["posted_ids_pending"] = app_data["posted_ids_pending"], []
+            appended += len(pending)
+            snapshot = list(app_data["posted_ids"]) if appended > POSTED_IDS_LIMIT else None
+        # Disk I/O runs in a worker thread, outside the lock, so posting never waits on it.
+        if snapshot is not None:
+            await asyncio.to_thread(compact_posted_ids, snapshot)
+            appended = 0
+        else:
+            await asyncio.to_thread(append_posted_ids, pending)
 
 # ---------- UTILITIES ----------
+def subreddit_name(submission) -> str:
+    # "r/name" comes with the submission payload, so no Subreddit object is needed for it.
+    prefixed = getattr(submission, "subreddit_name_prefixed", "")
+    return prefixed[2:] if prefixed.startswith("r/") else submission.subreddit.display_name
+
+def subreddit_key(submission) -> str:
+    # Mapping keys are stored lowercase; most display names already are, so skip the copy.
+    name = subreddit_name(submission)
+    return name if name.islower() else name.lower()
+
+# Same substitutions as html.escape(quote=True), applied in a single str.translate pass.
+HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+def escape_html(text) -> str:
+    return str(text).translate(HTML_ESCAPE_TABLE)
+
 def prepare_caption(submission):
-    author = submission.author.name if getattr(submission, "author", None) else "[deleted]"
+    author = getattr(submission.author, "name", "[deleted]") if getattr(submission, "author", None) else "[deleted]"
+    # Reddit restricts user and subreddit names to [A-Za-z0-9_-], so only free-text fields need escaping.
     return (
-        f"<b>{html.escape(getattr(submission, 'title', ''))}</b>\n\n"
-        f"Posted by u/{html.escape(author)} in r/{html.escape(submission.subreddit.display_name)}\n"
-        f"<a href='https://www.reddit.com{submission.permalink}'>Comments</a> | <a href='{html.escape(getattr(submission, 'url', ''))}'>Source</a>"
+        f"<b>{escape_html(getattr(submission, 'title', ''))}</b>\n\n"
+        f"Posted by u/{author} in r/{subreddit_name(submission)}\n"
+        f"<a href='https://www.reddit.com{submission.permalink}'>Comments</a> | <a href='{escape_html(getattr(submission, 'url', ''))}'>Source</a>"
     )
 
-async def fetch_bytes(session: aiohttp.ClientSession, url: str) -> Optional[BytesIO]:
-    try:
-        async with session.get(url, timeout=45) as resp:
+def media_filename(url: str) -> str:
+    return os.path.basename(urlsplit(url).path) or "file.dat"
+
+async def fetch_bytes(session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+    host = urlsplit(url).hostname or ""
+    async with _host_semaphores.setdefault(host, asyncio.Semaphore(FETCH_CONCURRENCY_PER_HOST)):
+        for attempt in range(FETCH_RETRIES + 1):
+            try:
+                async with session.get(url) as resp:
+                    if resp.status not in FETCH_RETRY_STATUSES or attempt == FETCH_RETRIES:
+                        resp.raise_for_status()
+                        if resp.content_length and resp.content_length > MAX_UPLOAD_BYTES:
+                            raise ValueError(f"{resp.content_length} bytes exceeds Telegram's upload limit")
+                        # Check the running size so chunked responses without a Content-Length are capped too.
+                        buf = bytearray()
+                        async for chunk in resp.content.iter_chunked(FETCH_CHUNK_SIZE):
+                            buf += chunk
+                            if len(buf) > MAX_UPLOAD_BYTES:
+                                raise ValueError(f"response exceeds Telegram's upload limit of {MAX_UPLOAD_BYTES} bytes")
+                        return bytes(buf)
+            except Exception as e:
+                logging.warning("Failed to fetch %s: %s", url, e)
+                return None
+            await asyncio.sleep(0.3 * 2 ** attempt)
+
+# ---------- MEDIA HANDLING ----------
+def is_direct_url(url: str) -> bool:
+    return urlsplit(url).hostname in DIRECT_MEDIA_HOSTS
+
+_redgifs_token: dict = {"value": None, "expires": 0.0}
+
+async def get_redgifs_token(session: aiohttp.ClientSession) -> str:
+    if _redgifs_token["value"] and time.monotonic() < _redgifs_token["expires"]:
+        return _redgifs_token["value"]
+    async with session.get(f"{REDGIFS_API_URL}/auth/temporary") as resp:
+        resp.raise_for_status()
+        token = (await resp.json(loads=JSON_LOADS))["token"]
+    _redgifs_token.update(value=token, expires=time.monotonic() + REDGIFS_TOKEN_TTL)
+    return token
+
+async def get_redgifs_api_mp4(session: aiohttp.ClientSession, url: str) -> Optional[str]:
+    gif_id = urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1].lower()
+    if not gif_id: return None
+    for attempt in range(2):
+        headers = {"Authorization": f"Bearer {await get_redgifs_token(session)}"}
+        async with session.get(f"{REDGIFS_API_URL}/gifs/{gif_id}", headers=headers) as resp:
+            if resp.status == 404: return None
+            # Temporary tokens can be revoked before they expire; fetch a fresh one and retry once.
+            if resp.status == 401 and attempt == 0:
+                _redgifs_token["value"] = None
+                continue
             resp.raise_for_status()
-            data = await resp.read()
-            bio = BytesIO(data)
-            bio.name = os.path.basename(url.split("?")[0]) or "file.dat"
-            return bio
-    except Exception as e:
-        logging.warning(f"Failed to fetch {url}: {e}")
+            urls = (await resp.json(loads=JSON_LOADS))["gif"]["urls"]
+        return urls.get("hd") or urls.get("sd")
+
+async def get_gfy_redgifs_mp4(session: aiohttp.ClientSession, url: str) -> Optional[str]:
+    # The Redgifs API hands back the mp4 URL directly; scrape the page when it fails or doesn't know the id.
+    if urlsplit(url).hostname.endswith("redgifs.com"):
+        try:
+            if (mp4_url := await get_redgifs_api_mp4(session, url)): return mp4_url
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Redgifs API lookup failed for %s, scraping the page instead: %s", url, e)
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        body = await resp.read()
+    # Only one attribute of one tag is needed, so scan the raw bytes instead of building a DOM.
+    for tag in SOURCE_TAG_RE.finditer(body):
+        attrs = {name.lower(): value for name, value in TAG_ATTR_RE.findall(tag.group())}
+        if attrs.get(b"type", b"").lower() == b"video/mp4" and (src := attrs.get(b"src")):
+            return html.unescape(src.decode())
+    return None
+
+async def get_dash_audio_url(session: aiohttp.ClientSession, dash_url: str) -> Optional[str]:
+    async with session.get(dash_url) as resp:
+        resp.raise_for_status()
+        manifest = await resp.read()
+    tracks = DASH_AUDIO_RE.findall(manifest)
+    if not tracks: return None
+    name, _ = max(tracks, key=lambda track: int(track[1] or 0))
+    return urljoin(dash_url, name.decode())
+
+async def fetch_dash_audio(session: aiohttp.ClientSession, dash_url: str) -> Optional[bytes]:
+    try:
+        audio_url = await get_dash_audio_url(session, dash_url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning("Failed to read DASH manifest %s: %s", dash_url, e)
         return None
+    return await fetch_bytes(session, audio_url) if audio_url else None
+
+def mux_tmp_dir(needed: int) -> Optional[str]:
+    # ffmpeg needs seekable files for +faststart, so RAM-backed /dev/shm is the cheapest scratch space.
+    # Docker caps it at 64 MB by default, so use it only if every concurrent upload could mux there at once.
+    try:
+        if shutil.disk_usage("/dev/shm").free >= needed * UPLOAD_CONCURRENCY: return "/dev/shm"
+    except OSError:
+        pass
+    return None
+
+async def mux_dash_video(video: bytes, audio: bytes) -> Optional[bytes]:
+    # Reddit serves H.264 video and AAC audio as separate streams; -c copy only remuxes them.
+    # Any failure here only costs the soundtrack, so it is logged and the caller sends the silent video.
+    try:
+        with tempfile.TemporaryDirectory(dir=mux_tmp_dir(2 * (len(video) + len(audio)))) as tmp:
+            video_path, audio_path, output_path = (os.path.join(tmp, name) for name in ("video.mp4", "audio.mp4", "output.mp4"))
+            def write_inputs():
+                with open(video_path, "wb") as f: f.write(video)
+                with open(audio_path, "wb") as f: f.write(audio)
+            await asyncio.to_thread(write_inputs)
+            proc = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH, "-y", "-loglevel", "error", "-i", video_path, "-i", audio_path,
+                "-c", "copy", "-movflags", "+faststart", output_path,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), MUX_TIMEOUT)
+            finally:
+                # Covers the timeout and task cancellation alike, so no ffmpeg outlives its post.
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+            if proc.returncode != 0:
+                logging.warning("ffmpeg mux failed: %s", stderr.decode(errors="replace").strip())
+                return None
+            def read_output():
+                with open(output_path, "rb") as f: return f.read()
+            return await asyncio.to_thread(read_output)
+    except (OSError, asyncio.TimeoutError) as e:
+        logging.warning("Could not mux Reddit video audio, sending it without sound: %r", e)
+        return None
+
+async def fetch_media(session: aiohttp.ClientSession, media) -> Optional[bytes]:
+    if not media.get("dash_url"):
+        return await fetch_bytes(session, media["url"])
+    # The manifest lookup and audio download overlap the video download instead of delaying the post.
+    video, audio = await asyncio.gather(fetch_bytes(session, media["url"]), fetch_dash_audio(session, media["dash_url"]))
+    if video and audio and (muxed := await mux_dash_video(video, audio)) and len(muxed) <= MAX_UPLOAD_BYTES:
+        return muxed
+    return video
 
-# ---------- MEDIA HANDLING ----------
 async def get_media_urls(submission, session):
     media_list = []
-    url_lower = getattr(submission, "url", "").lower()
+    url_parts = urlsplit(getattr(submission, "url", ""))
+    extension = os.path.splitext(url_parts.path.lower())[1]
     try:
         if getattr(submission, "is_gallery", False) and hasattr(submission, "media_metadata"):
+            metadata = submission.media_metadata
             for item in submission.gallery_data['items']:
-                media_id = item['media_id']
-                if media_id in submission.media_metadata and submission.media_metadata[media_id]['e'] == 'Image':
-                    url = submission.media_metadata[media_id]['s']['u'].replace("&amp;", "&")
-                    media_list.append({"url": url, "type": "photo"})
+                meta = metadata.get(item['media_id'])
+                if meta and meta['e'] == 'Image':
+                    url = html.unescape(meta['s']['u'])
+                    media_list.append({"url": url, "type": "photo", "direct": is_direct_url(url)})
+                    if len(media_list) == MAX_MEDIA_GROUP_SIZE: break
         elif getattr(submission, "is_video", False) and hasattr(submission, "media") and submission.media.get("reddit_video"):
-            media_list.append({"url": submission.media["reddit_video"]["fallback_url"], "type": "video"})
-        elif any(url_lower.endswith(ext) for ext in [".jpg", ".jpeg", ".png"]):
-            media_list.append({"url": submission.url, "type": "photo"})
-        elif any(url_lower.endswith(ext) for ext in [".gif", ".mp4"]):
-            media_list.append({"url": submission.url, "type": "gif" if url_lower.endswith(".gif") else "video"})
-        elif "gfycat.com" in url_lower or "redgifs.com" in url_lower:
-            async with session.get(submission.url) as resp: text = await resp.text()
-            soup = BeautifulSoup(text, "html.parser")
-            if (mp4_tag := soup.find("source", {"type": "video/mp4", "src": True})):
-                media_list.append({"url": mp4_tag["src"], "type": "video"})
+            reddit_video = submission.media["reddit_video"]
+            # Silent clips and gifs have no audio track, and without ffmpeg it can't be muxed in,
+            # so the manifest and audio download would be wasted.
+            mux_audio = FFMPEG_PATH and reddit_video.get("has_audio", True) and not reddit_video.get("is_gif")
+            media_list.append({
+                "url": reddit_video["fallback_url"], "type": "video", "direct": False,
+                "dash_url": reddit_video.get("dash_url") if mux_audio else None,
+            })
+        elif (media_type := EXTENSION_MEDIA_TYPES.get(extension)):
+            media_list.append({"url": submission.url, "type": media_type, "direct": media_type == "gif" or is_direct_url(submission.url)})
+        elif url_parts.hostname in GFY_REDGIFS_HOSTS:
+            if (mp4_url := await get_gfy_redgifs_mp4(session, submission.url)):
+                media_list.append({"url": mp4_url, "type": "video", "direct": False})
     except Exception as e:
-        logging.warning(f"Failed to get media URLs for post {getattr(submission, 'id', '?')}: {e}")
+        logging.warning("Failed to get media URLs for post %s: %s", getattr(submission, "id", "?"), e)
     return media_list
 
 # ---------- SAFE SEND HELPER ----------
-async def _safe_send(primary_fn: Callable[[], Awaitable], fallback_fn: Optional[Callable[[], Awaitable]] = None):
+SEND_RETRIES = 3
+FLOOD_WAIT_RETRIES = 5
+
+class RateLimiter:
+    # Token bucket: up to `rate` sends per `period` seconds, refilled continuously.
+    def __init__(self, rate: int, period: float):
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.period)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.period / self.rate)
+
+# Bot API limits: ~30 messages/s per bot and 20 messages/min into a single group.
+_global_send_limiter = RateLimiter(30, 1)
+_group_send_limiter = RateLimiter(20, 60)
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    # PTB 22.2+ warns on reading an int retry_after and will return a timedelta in its next major release.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+
+async def _safe_send(primary_fn: Callable[[], Awaitable], fallback_fn: Optional[Callable[[], Awaitable]] = None, retry_timeouts: bool = False):
+    send_fn = primary_fn
+    attempt = flood_waits = 0
+    while True:
+        await _global_send_limiter.acquire()
+        await _group_send_limiter.acquire()
+        try:
+            return await send_fn()
+        except RetryAfter as e:
+            # Not a failed attempt; pausing the shared limiter holds back every other send as well.
+            flood_waits += 1
+            if flood_waits > FLOOD_WAIT_RETRIES: raise
+            delay = retry_after_seconds(e)
+            logging.warning("Telegram flood control, pausing sends for %ss", delay)
+            _global_send_limiter.pause(delay)
+        except TimedOut as e:
+            # A read timeout means Telegram got the whole request and may have posted it, so re-sending an
+            # upload or media group would duplicate the post. Connect, pool and write timeouts never reached
+            # Telegram and are raised, so the post is reported and not recorded. Only callers that opt in are retried.
+            if not retry_timeouts:
+                if isinstance(e.__cause__, httpx.ReadTimeout):
+                    logging.warning("Telegram send timed out after upload and may still have been delivered; not retrying: %s", e)
+                    return None
+                raise
+            if attempt == SEND_RETRIES: raise
+            # Capped exponential backoff; jitter keeps parallel senders from retrying in lockstep.
+            delay = min(30, 2 ** attempt) + random.uniform(0, 0.5)
+            attempt += 1
+            logging.warning("Telegram send timed out, retrying in %.1fs: %s", delay, e)
+            await asyncio.sleep(delay)
+        except BadRequest as e:
+            msg = str(e).lower()
+            if fallback_fn and send_fn is primary_fn and ("topic_closed" in msg or "topic is closed" in msg):
+                logging.warning("Topic closed, attempting to send to main group.")
+                send_fn = fallback_fn
+                continue
+            raise
+
+def is_url_rejection(error: BadRequest) -> bool:
+    # Telegram's wording when it can't (or won't) fetch a media URL itself.
+    msg = str(error).lower()
+    return "http url" in msg or "web page content" in msg or "wrong file identifier" in msg
+
+async def _send_with_upload_fallback(send: Callable[[bool], Awaitable], media_items):
     try:
-        return await primary_fn()
-    except (BadRequest, TimedOut) as e:
-        msg = str(e).lower()
-        if "topic_closed" in msg or "topic is closed" in msg:
-            logging.warning("Topic closed, attempting to send to main group.")
-            if fallback_fn: return await fallback_fn()
-        raise e
+        await send(True)
+    except BadRequest as e:
+        if not (is_url_rejection(e) and any(m["direct"] for m in media_items)): raise
+        logging.warning("Telegram rejected media URL(s), uploading the files instead: %s", e)
+        await send(False)
 
 # ---------- SEND MEDIA & ERROR REPORTING ----------
 async def report_error(bot, submission, error):
-    logging.error(f"Error processing post {submission.id}: {error}")
+    logging.error("Error processing post %s: %s", submission.id, error)
+    # Only read fields that came with the submission payload; this runs on the failure path.
     error_text = (
         f"⚠️ <b>Error Processing Post</b> ⚠️\n\n"
-        f"<b>Title:</b> {html.escape(submission.title)}\n"
-        f"<b>Subreddit:</b> r/{submission.subreddit.display_name}\n"
-        f"<b>Link:</b> https://www.reddit.com{submission.permalink}\n\n"
-        f"<b>Reason:</b>\n<pre>{html.escape(str(error))}</pre>"
+        f"<b>Title:</b> {escape_html(getattr(submission, 'title', ''))}\n"
+        f"<b>Subreddit:</b> r/{subreddit_name(submission)}\n"
+        f"<b>Link:</b> https://www.reddit.com{getattr(submission, 'permalink', '/comments/' + submission.id)}\n\n"
+        f"<b>Reason:</b>\n<pre>{escape_html(error)}</pre>"
     )
     try:
         await bot.send_message(chat_id=TELEGRAM_GROUP_ID, message_thread_id=TELEGRAM_ERROR_TOPIC_ID, text=error_text, parse_mode=ParseMode.HTML)
     except Exception as e:
-        logging.exception(f"CRITICAL: Could not send failure notice to error topic: {e}")
+        logging.exception("CRITICAL: Could not send failure notice to error topic: %s", e)
+
+# Media type -> (Bot method, keyword that carries the file).
+SINGLE_SEND_METHODS = {
+    "photo": ("send_photo", "photo"),
+    "video": ("send_video", "video"),
+    "gif": ("send_animation", "animation"),
+}
 
-async def send_media(submission, topic_id, bot):
+async def send_media(submission, topic_id, bot, session: aiohttp.ClientSession):
     caption = prepare_caption(submission)
     send_params = {"chat_id": TELEGRAM_GROUP_ID, "message_thread_id": topic_id, "caption": caption, "parse_mode": ParseMode.HTML}
     fallback_params = {k: v for k, v in send_params.items() if k != "message_thread_id"}
     text_params = {**{k: v for k, v in send_params.items() if k != "caption"}, "text": caption}
+    send_text = partial(
+        _safe_send,
+        partial(bot.send_message, **text_params),
+        partial(bot.send_message, **{k: v for k, v in text_params.items() if k != "message_thread_id"}),
+        retry_timeouts=True,
+    )
 
-    async with aiohttp.ClientSession() as session:
-        media_list = await get_media_urls(submission, session)
+    media_list = await get_media_urls(submission, session)
 
-        if not media_list:
-            await _safe_send(lambda: bot.send_message(**text_params))
-        elif len(media_list) > 1:
-            media_bytes = await asyncio.gather(*(fetch_bytes(session, m["url"]) for m in media_list[:10]))
-            tg_media = [InputMediaPhoto(media=bio, caption=caption if i == 0 else None, parse_mode=ParseMode.HTML) for i, bio in enumerate(media_bytes) if bio]
-            if tg_media:
+    if not media_list:
+        await send_text()
+    elif len(media_list) > 1:
+        async def send_gallery(allow_direct):
+            async def resolve(media):
+                if allow_direct and media["direct"]: return media, media["url"]
+                return media, await fetch_bytes(session, media["url"])
+            tg_media = []
+            for media, payload in await asyncio.gather(*(resolve(m) for m in media_list)):
+                if not payload: continue
+                tg_media.append(InputMediaPhoto(
+                    media=payload, filename=media_filename(media["url"]),
+                    caption=None if tg_media else caption, parse_mode=ParseMode.HTML,
+                ))
+            if not tg_media:
+                logging.warning("All gallery downloads failed for post %s; sending it as a text post.", submission.id)
+                return await send_text()
+            await _safe_send(
+                partial(bot.send_media_group, chat_id=TELEGRAM_GROUP_ID, message_thread_id=topic_id, media=tg_media),
+                partial(bot.send_media_group, chat_id=TELEGRAM_GROUP_ID, media=tg_media)
+            )
+        await _send_with_upload_fallback(send_gallery, media_list)
+    else:
+        media = media_list[0]
+        if (dispatch := SINGLE_SEND_METHODS.get(media["type"])):
+            method_name, media_kwarg = dispatch
+            send_func = getattr(bot, method_name)
+            filename = media_filename(media["url"])
+            async def send_single(allow_direct):
+                payload = media["url"] if allow_direct and media["direct"] else await fetch_media(session, media)
+                if not payload:
+                    logging.warning("Media download failed for post %s; sending it as a text post.", submission.id)
+                    return await send_text()
                 await _safe_send(
-                    lambda: bot.send_media_group(chat_id=TELEGRAM_GROUP_ID, message_thread_id=topic_id, media=tg_media),
-                    lambda: bot.send_media_group(chat_id=TELEGRAM_GROUP_ID, media=tg_media)
-                )
-        else:
-            media = media_list[0]
-            bio = await fetch_bytes(session, media["url"])
-            if not bio: raise ValueError("Media download failed or returned empty.")
-            
-            send_map = {"photo": bot.send_photo, "video": bot.send_video, "gif": bot.send_animation}
-            send_func = send_map.get(media["type"])
-            if send_func:
-                media_kwarg = "animation" if media["type"] == "gif" else media["type"]
-                await _safe_send(
-                    lambda: send_func(**{media_kwarg: bio}, **send_params),
-                    lambda: send_func(**{media_kwarg: bio}, **fallback_params)
+                    partial(send_func, **{media_kwarg: payload}, filename=filename, **send_params),
+                    partial(send_func, **{media_kwarg: payload}, filename=filename, **fallback_params)
                 )
+            await _send_with_upload_fallback(send_single, media_list)
 
     logging.info("Post sent: %s to topic %s", submission.title, topic_id)
     return True
@@ -194,16 +601,18 @@ async def send_media(submission, topic_id, bot):
 # ---------- CORE SUBMISSION PROCESSING ----------
 async def process_submission(submission, context: ContextTypes.DEFAULT_TYPE):
     app_data = context.application.bot_data
-    async with app_data["posted_ids_lock"]:
-        if submission.id in app_data["posted_ids"]: return
+    if submission.id in app_data["posted_ids"]: return
 
-    topic_id = app_data["subreddit_map"].get(submission.subreddit.display_name.lower(), TELEGRAM_ERROR_TOPIC_ID)
+    topic_id = app_data["subreddit_map"].get(subreddit_key(submission), TELEGRAM_ERROR_TOPIC_ID)
     
     try:
-        if await send_media(submission, topic_id, context.bot):
+        async with app_data["upload_sem"]:
+            sent = await send_media(submission, topic_id, context.bot, app_data["http_session"])
+        if sent:
             async with app_data["posted_ids_lock"]:
                 app_data["posted_ids"].add(submission.id)
-                save_posted_ids(app_data["posted_ids"])
+                app_data["posted_ids_pending"].append(submission.id)
+            app_data["posted_ids_dirty"].set()
     except Exception as e:
         await report_error(context.bot, submission, e)
 
@@ -213,6 +622,10 @@ async def post_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args: return await msg.reply_text("Usage: /post <reddit_url>")
     if not (reddit := context.application.bot_data.get("reddit_client")):
         return await msg.reply_text("Reddit client not ready.")
+    # Most links already carry the submission id, so repeats need no Reddit round-trip.
+    # Anything else still goes to asyncpraw, which decides whether it is a post URL.
+    if (link := REDDIT_LINK_RE.match(context.args[0])) and link.group(1).lower() in context.application.bot_data["posted_ids"]:
+        return await msg.reply_text("That post has already been sent.")
     try:
         submission = await reddit.submission(url=context.args[0])
         # Manually trigger processing
@@ -221,33 +634,68 @@ async def post_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await msg.reply_text(f"Error fetching Reddit URL: {e}")
 
+async def add_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    # ASCII digits only: str.isdigit() also passes characters like "²" that int() rejects.
+    if len(context.args) != 2 or not re.fullmatch(r"-?[0-9]+", context.args[1]):
+        return await msg.reply_text("Usage: /add <subreddit> <topic_id>")
+    name, topic_id = context.args[0].removeprefix("r/"), int(context.args[1])
+    try:
+        await context.application.bot_data["reddit_client"].subreddit(name, fetch=True)
+    except Exception as e:
+        return await msg.reply_text(f"Could not find r/{name}: {e}")
+
+    subreddit_map = context.application.bot_data["subreddit_map"]
+    subreddit_map[name.lower()] = topic_id
+    await asyncio.to_thread(save_subreddit_topic, SUBREDDITS_DB_PATH, name, topic_id)
+    await stop_and_restart_stream(context.application)
+    await msg.reply_text(f"Added r/{name} (topic {topic_id}). Now monitoring {len(subreddit_map)} subreddits.")
+
 async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text("Reloading subreddits and restarting stream...")
-    context.application.bot_data["subreddit_map"] = load_subreddits_mapping(SUBREDDITS_DB_PATH)
+    context.application.bot_data["subreddit_map"] = await asyncio.to_thread(load_subreddits_mapping, SUBREDDITS_DB_PATH)
     await stop_and_restart_stream(context.application)
-    new_subs = ", ".join(context.application.bot_data["subreddit_map"].keys())
+    new_subs = ", ".join(context.application.bot_data["subreddit_map"])
     await update.effective_message.reply_text(f"Reload complete. Now monitoring: {new_subs or 'None'}")
 
 # ---------- STREAMING LOGIC ----------
+SUBMISSION_WORKERS = 8
+SUBMISSION_QUEUE_SIZE = 64
+
+async def submission_worker(app: Application):
+    context = ContextTypes.DEFAULT_TYPE(application=app)
+    queue = app.bot_data["submission_queue"]
+    while True:
+        submission = await queue.get()
+        try:
+            await process_submission(submission, context)
+        except Exception:
+            logging.exception("Worker failed on submission %s", getattr(submission, "id", "?"))
+        finally:
+            queue.task_done()
+
 async def stream_subreddits_task(app: Application):
     subreddit_map = app.bot_data["subreddit_map"]
     if not subreddit_map:
         logging.warning("No subreddits configured. Stream will not start.")
         return
 
-    subreddit_names = "+".join(subreddit_map.keys())
-    logging.info(f"Starting stream for subreddits: {subreddit_names}")
+    subreddit_names = "+".join(subreddit_map)
+    logging.info("Starting stream for subreddits: %s", subreddit_names)
+    queue, posted_ids = app.bot_data["submission_queue"], app.bot_data["posted_ids"]
     try:
         subreddit = await app.bot_data["reddit_client"].subreddit(subreddit_names)
         async for submission in subreddit.stream.submissions(skip_existing=True):
-            context = ContextTypes.DEFAULT_TYPE(application=app)
-            asyncio.create_task(process_submission(submission, context))
+            # Replays after a restart are dropped here, before they take a queue slot or any download.
+            if submission.id in posted_ids: continue
+            # Blocks while the workers are saturated, so a burst applies back-pressure to the stream.
+            await queue.put(submission)
     except asyncio.CancelledError:
         logging.info("Subreddit stream task was cancelled.")
     except Exception as e:
-        logging.exception(f"Subreddit stream failed: {e}")
+        logging.exception("Subreddit stream failed: %s", e)
         # Notify admin of critical stream failure
-        error_text = f"🚨 **CRITICAL: Reddit Stream Failure** 🚨\n\nThe bot's Reddit stream has crashed and will not automatically restart.\n\n**Error:**\n`{html.escape(str(e))}`"
+        error_text = f"🚨 <b>CRITICAL: Reddit Stream Failure</b> 🚨\n\nThe bot's Reddit stream has crashed and will not automatically restart.\n\n<b>Error:</b>\n<pre>{escape_html(e)}</pre>"
         await app.bot.send_message(chat_id=TELEGRAM_GROUP_ID, message_thread_id=TELEGRAM_ERROR_TOPIC_ID, text=error_text, parse_mode=ParseMode.HTML)
 
 async def stop_and_restart_stream(app: Application):
@@ -260,15 +708,27 @@ async def stop_and_restart_stream(app: Application):
 # ---------- STARTUP / SHUTDOWN / ERROR HANDLER ----------
 async def on_startup(app: Application):
     logging.info("Bot starting up...")
+    if not FFMPEG_PATH:
+        logging.warning("ffmpeg not found on PATH; Reddit videos will be posted without sound.")
+    # Reddit's API gets its own pool so the stream's long-lived connections never queue behind media downloads.
+    app.bot_data["reddit_session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=75),
+    )
     app.bot_data["reddit_client"] = asyncpraw.Reddit(
         client_id=REDDIT_CLIENT_ID, client_secret=REDDIT_CLIENT_SECRET,
         username=REDDIT_USERNAME, password=REDDIT_PASSWORD,
-        user_agent="TelegramRedditBot/2.2 by anarq42",
+        user_agent=USER_AGENT, requestor_kwargs={"session": app.bot_data["reddit_session"]},
     )
     app.bot_data.update({
-        "posted_ids": load_posted_ids(), "posted_ids_lock": asyncio.Lock(),
-        "subreddit_map": load_subreddits_mapping(SUBREDDITS_DB_PATH)
+        "http_session": create_http_session(), "upload_sem": asyncio.Semaphore(UPLOAD_CONCURRENCY),
+        "submission_queue": asyncio.Queue(maxsize=SUBMISSION_QUEUE_SIZE),
+        "posted_ids": await asyncio.to_thread(load_posted_ids), "posted_ids_lock": asyncio.Lock(),
+        "posted_ids_pending": [], "posted_ids_dirty": asyncio.Event(),
+        "subreddit_map": await asyncio.to_thread(load_subreddits_mapping, SUBREDDITS_DB_PATH)
     })
+    await asyncio.to_thread(compact_posted_ids, list(app.bot_data["posted_ids"]))
+    app.bot_data["flush_task"] = asyncio.create_task(flush_posted_ids_task(app))
+    app.bot_data["submission_workers"] = [asyncio.create_task(submission_worker(app)) for _ in range(SUBMISSION_WORKERS)]
     await stop_and_restart_stream(app)
     logging.info("Startup complete.")
 
@@ -278,7 +738,28 @@ async def on_shutdown(app: Application):
         task.cancel()
         try: await task
         except asyncio.CancelledError: logging.info("Subreddit stream task successfully cancelled.")
+    if (task := app.bot_data.get("flush_task")) and not task.done():
+        task.cancel()
+        try: await task
+        except asyncio.CancelledError: pass
+    # Persist what was already posted before anything slow; draining a rate-limited backlog could
+    # outlast the platform's stop timeout, and ids lost to a SIGKILL get re-posted on restart.
+    flush_pending_posted_ids(app)
+    if (queue := app.bot_data.get("submission_queue")) and queue.qsize():
+        # The stream restarts with skip_existing=True and never sees these again; log them for a manual /post.
+        logging.warning("Dropping %d queued submissions; re-send them with /post:", queue.qsize())
+        while not queue.empty():
+            submission = queue.get_nowait()
+            logging.warning("Dropped submission %s: https://www.reddit.com%s", getattr(submission, "id", "?"), getattr(submission, "permalink", ""))
+            queue.task_done()
+    if (workers := app.bot_data.get("submission_workers")):
+        for worker in workers: worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    # Posts that finished while the workers were being stopped.
+    flush_pending_posted_ids(app)
     if (reddit := app.bot_data.get("reddit_client")): await reddit.close()
+    if (session := app.bot_data.get("reddit_session")) and not session.closed: await session.close()
+    if (session := app.bot_data.get("http_session")): await session.close()
     logging.info("Shutdown complete.")
 
 async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -286,7 +767,7 @@ async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYP
     error_text = (
         f"🆘 <b>CRITICAL: Unhandled Bot Exception</b> 🆘\n\n"
         f"The bot encountered an error it could not recover from.\n\n"
-        f"<b>Error:</b>\n<pre>{html.escape(str(context.error))}</pre>"
+        f"<b>Error:</b>\n<pre>{escape_html(context.error)}</pre>"
     )
     try:
         await context.bot.send_message(chat_id=TELEGRAM_GROUP_ID, message_thread_id=TELEGRAM_ERROR_TOPIC_ID, text=error_text, parse_mode=ParseMode.HTML)
@@ -295,12 +776,15 @@ async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYP
 
 # ---------- MAIN ----------
 def main():
+    if uvloop:
+        uvloop.install()
     app = (
-        Application.builder().token(TELEGRAM_TOKEN)
+        Application.builder().token(TELEGRAM_TOKEN).media_write_timeout(MEDIA_WRITE_TIMEOUT)
         .post_init(on_startup).post_shutdown(on_shutdown).build()
     )
     admin_filter = filters.User(user_id=TELEGRAM_ADMIN_ID)
     app.add_handler(CommandHandler("post", post_command))
+    app.add_handler(CommandHandler("add", add_command, filters=admin_filter))
     app.add_handler(CommandHandler("reload", reload_command, filters=admin_filter))
     app.add_error_handler(global_error_handler)
     